@@ -1,37 +1,45 @@
+import hashlib
+import json
+import os
 import time
+import numpy as np
 import pandas as pd
 import joblib
 import paho.mqtt.client as mqtt
 
+from mqtt_shared import set_tcp_nodelay
+
+try:
+    import onnxruntime as ort
+except ImportError:  # optional: fall back to the sklearn model
+    ort = None
+
 # -----------------------------------------------------------
 # USER SETTINGS
 # -----------------------------------------------------------
 FEATURES_CSV = "features.csv"
 MODEL_PATH = "stability_model.pkl"
 SCALER_PATH = "stability_scaler.pkl"
+ONNX_MODEL_PATH = "stability.onnx"  # optional, produced by export_onnx.py
+CACHE_DIR = ".cache"  # on-disk cache of model outputs, keyed by features + model
+CHUNK_SIZE = 100_000  # rows per chunk; bounds peak memory on long logs
 
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
 
 # Single-slot topics
-MQTT_TOPIC_STATE = "smartparking/slot1/state"
 MQTT_TOPIC_EVENT = "smartparking/slot1/event"
+# CHANGE event + new state in one JSON message; replaces the separate
+# smartparking/slot1/state publish, which the simulator no longer emits
+MQTT_TOPIC_BATCH = "smartparking/slot1/batch"
 MQTT_TOPIC_METRICS = "smartparking/metrics/transmissions"
 
 SEND_INTERVAL = 0.05
 CHANGE_THRESHOLD_MM = 300
 
 # -----------------------------------------------------------
-# LOAD MODEL + FEATURES
+# LOAD FEATURES
 # -----------------------------------------------------------
-print("Loading features.csv...")
-df = pd.read_csv(FEATURES_CSV, parse_dates=["timestamp"])
-df = df.sort_values("timestamp").reset_index(drop=True)
-
-print("Loading ML model...")
-clf = joblib.load(MODEL_PATH)
-scaler = joblib.load(SCALER_PATH)
-
 FEATURE_COLS = [
     "g0_min","g1_min","g2_min",
     "g0_mean","g1_mean","g2_mean",
@@ -39,19 +47,131 @@ FEATURE_COLS = [
     "tof_min_all","tof_mean_all","tof_mean_all_diff",
 ]
 
+
+def check_chunk_order():
+    """Raise if chunked replay would go out of time order.
+
+    Rows are only sorted within a chunk, so a chunk starting before the end
+    of the previous one (e.g. concatenated per-case logs longer than
+    CHUNK_SIZE) cannot be replayed correctly. Only the timestamp column is
+    read, so this pass is cheap and memory stays bounded.
+    """
+    prev_max = None
+    reader = pd.read_csv(
+        FEATURES_CSV,
+        usecols=["timestamp"],
+        parse_dates=["timestamp"],
+        engine="c",
+        chunksize=CHUNK_SIZE,
+    )
+    for n, chunk in enumerate(reader):
+        ts = chunk["timestamp"]
+        if prev_max is not None and ts.min() < prev_max:
+            raise ValueError(
+                f"{FEATURES_CSV}: chunk {n} starts at {ts.min()}, "
+                f"before the previous chunk's last row ({prev_max}). Sort the file "
+                f"by timestamp or raise CHUNK_SIZE above its row count."
+            )
+        prev_max = ts.max()
+
+
+def feature_chunks():
+    """Return an iterator over CHUNK_SIZE-row chunks of features.csv, each sorted by timestamp.
+
+    The ordering check runs here, before any chunk is read or published.
+    """
+    print("Loading features.csv...")
+    check_chunk_order()
+    # only the model inputs (g1_min doubles as the occupancy signal) + timestamp,
+    # with dtypes given up front so pandas skips inference
+    reader = pd.read_csv(
+        FEATURES_CSV,
+        usecols=["timestamp"] + FEATURE_COLS,
+        dtype={c: np.float32 for c in FEATURE_COLS},
+        parse_dates=["timestamp"],
+        engine="c",
+        chunksize=CHUNK_SIZE,
+    )
+    return (chunk.sort_values("timestamp").reset_index(drop=True) for chunk in reader)
+
+
 # -----------------------------------------------------------
 # PREPARE OCCUPANCY + PREDICTION
 # -----------------------------------------------------------
-df["occupied_now"] = (df["g1_min"] < CHANGE_THRESHOLD_MM).astype(int)
+def sigmoid(z):
+    return 1 / (1 + np.exp(-z))
+
+
+def load_model(use_onnx):
+    """Return predict(X) -> per-row change logits for standardized float32 X."""
+    # logits are a single (n,) array; P(change) > 0.5 <=> logit > 0
+    if use_onnx:
+        sess = ort.InferenceSession(ONNX_MODEL_PATH, providers=["CPUExecutionProvider"])
+        # exported with raw_scores, so "probabilities" holds logits
+        return lambda X: sess.run(["probabilities"], {"X": X})[0][:, 1]
+
+    clf = joblib.load(MODEL_PATH)
+    if hasattr(clf, "decision_function"):
+        return clf.decision_function
+
+    def predict(X):
+        p = np.clip(clf.predict_proba(X)[:, 1], 1e-12, 1 - 1e-12)
+        return np.log(p / (1 - p))
+    return predict
+
+
+def predict_chunks(chunks):
+    """Yield (chunk, pred_score) pairs, reusing cached scores for unchanged inputs."""
+    md5 = hashlib.md5()
+    with open(FEATURES_CSV, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    key = f"{md5.hexdigest()}_{CHUNK_SIZE}"
+    key += f"_{os.path.getmtime(MODEL_PATH)}_{os.path.getmtime(SCALER_PATH)}"
+    use_onnx = ort is not None and os.path.exists(ONNX_MODEL_PATH)
+    if use_onnx and os.path.getmtime(ONNX_MODEL_PATH) < os.path.getmtime(MODEL_PATH):
+        print(f"WARNING: {ONNX_MODEL_PATH} is older than {MODEL_PATH}; "
+              "re-run export_onnx.py. Using the sklearn model instead.")
+        use_onnx = False
+    if use_onnx:
+        key += f"_onnx{os.path.getmtime(ONNX_MODEL_PATH)}"
+    cache_path = os.path.join(CACHE_DIR, f"scores_{key}")  # one .npy per chunk
+
+    if os.path.isdir(cache_path):
+        print("Loading cached predictions...")
+        for n, chunk in enumerate(chunks):
+            yield chunk, np.load(os.path.join(cache_path, f"{n:06d}.npy"))
+        return
+
+    print("Loading ML model...")
+    scaler = joblib.load(SCALER_PATH)
+    predict = load_model(use_onnx)
+
+    # plain numpy standardization: skips sklearn's per-call validation and
+    # hands the model one contiguous float32 matrix
+    mean = scaler.mean_.astype(np.float32)
+    scale = scaler.scale_.astype(np.float32)
+
+    tmp_path = cache_path + ".tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    for n, chunk in enumerate(chunks):
+        X = (chunk[FEATURE_COLS].to_numpy(dtype=np.float32) - mean) / scale
+        pred_score = predict(X)
+        np.save(os.path.join(tmp_path, f"{n:06d}.npy"), pred_score)
+        yield chunk, pred_score
+    os.replace(tmp_path, cache_path)  # only complete runs become cache hits
 
-X = scaler.transform(df[FEATURE_COLS])
-df["pred_prob"] = clf.predict_proba(X)[:, 1]
-df["pred_label"] = (df["pred_prob"] > 0.5).astype(int)
 
 # -----------------------------------------------------------
 # MQTT SETUP
 # -----------------------------------------------------------
 client = mqtt.Client()
+# disable Nagle so small event publishes go out immediately (also after reconnects)
+client.on_socket_open = set_tcp_nodelay
+# Only affect QoS>0: a wide inflight window and an unbounded queue
+# (0, paho's default). The qos=0 event publishes below are unaffected.
+client.max_inflight_messages_set(1000)
+client.max_queued_messages_set(0)
 print(f"Connecting to MQTT broker {MQTT_BROKER}:{MQTT_PORT} ...")
 client.connect(MQTT_BROKER, MQTT_PORT, 60)
 client.loop_start()
@@ -60,50 +180,78 @@ print("Connected!")
 # -----------------------------------------------------------
 # SIMULATION LOOP (single slot)
 # -----------------------------------------------------------
-def run_simulation(df):
-    last_state = df.loc[0, "occupied_now"]
-    edge_tx = 0
-    trad_tx = 0
+EVENT_CHANGE = 0
+EVENT_PRED = 1
 
-    print("\n--- Starting EdgeAI Parking Simulation (slot1) ---\n")
 
-    for _, row in df.iterrows():
-        occ = row["occupied_now"]
-        pred = row["pred_label"]
-        prob = row["pred_prob"]
+def compute_schedule(occ, pred, last_state=None):
+    """Return (idxs, kinds) of rows that must be transmitted, in row order.
 
-        trad_tx += 1  # baseline system always sends
+    last_state is the occupancy of the row before occ[0] (previous chunk);
+    without it, row 0 is the reference state and never a change.
+    """
+    # RULE 1: ACTUAL CHANGE
+    ref = occ[0] if last_state is None else last_state
+    changes = np.flatnonzero(np.diff(occ, prepend=ref))
+    # RULE 2: PREDICTED CHANGE, unless the row already sends a CHANGE
+    pred_only = np.setdiff1d(np.flatnonzero(pred == 1), changes, assume_unique=True)
+    # RULE 3: STABLE → SUPPRESS (every other row)
 
-        # RULE 1: ACTUAL CHANGE
-        if occ != last_state:
-            last_state = occ
-            edge_tx += 1
+    idxs = np.concatenate((changes, pred_only))
+    kinds = np.concatenate((
+        np.full(len(changes), EVENT_CHANGE, dtype=np.int8),
+        np.full(len(pred_only), EVENT_PRED, dtype=np.int8),
+    ))
+    order = np.argsort(idxs, kind="stable")
+    return idxs[order], kinds[order]
 
-            client.publish(MQTT_TOPIC_EVENT, f"CHANGE: state={occ}, ts={row['timestamp']}")
-            client.publish(MQTT_TOPIC_STATE, f"{occ}")
 
-            print(f"[TX] CHANGE → {occ}")
-            time.sleep(SEND_INTERVAL)
-            continue
+def run_simulation(df, last_state=None):
+    """Replay one chunk; returns (edge_tx, trad_tx, last occupancy state)."""
+    occ = df["occupied_now"].to_numpy()
+    pred = df["pred_label"].to_numpy()
+    score = df["pred_score"].to_numpy()
+    ts = df["timestamp"].to_numpy()
 
-        # RULE 2: PREDICTED CHANGE
-        if pred == 1:
-            edge_tx += 1
-            client.publish(MQTT_TOPIC_EVENT, f"PRED_CHANGE: prob={prob:.3f}, ts={row['timestamp']}")
-            print(f"[TX] PRED_CHANGE (prob={prob:.3f})")
-            time.sleep(SEND_INTERVAL)
-            continue
+    idxs, kinds = compute_schedule(occ, pred, last_state)
 
-        # RULE 3: STABLE → SUPPRESS
+    edge_tx = len(idxs)
+    trad_tx = len(occ)  # baseline system always sends
+
+    # qos=0 publish() only enqueues for loop_start()'s network thread and
+    # never waits for the broker, so only transmitted events pace the replay
+    for i, kind in zip(idxs, kinds):
+        if kind == EVENT_CHANGE:
+            client.publish(
+                MQTT_TOPIC_BATCH,
+                json.dumps({"state": int(occ[i]), "event": "CHANGE", "ts": str(pd.Timestamp(ts[i]))}),
+                qos=0,
+            )
+            print(f"[TX] CHANGE → {occ[i]}")
+        else:
+            prob = sigmoid(score[i])  # only PRED_CHANGE rows need the probability
+            client.publish(MQTT_TOPIC_EVENT, f"PRED_CHANGE: prob={prob:.3f}, ts={pd.Timestamp(ts[i])}", qos=0)
+            print(f"[TX] PRED_CHANGE (prob={prob:.3f})")
         time.sleep(SEND_INTERVAL)
 
-    return edge_tx, trad_tx
+    return edge_tx, trad_tx, occ[-1]
 
 # -----------------------------------------------------------
 # MAIN
 # -----------------------------------------------------------
 if __name__ == "__main__":
-    edge_tx, trad_tx = run_simulation(df)
+    print("\n--- Starting EdgeAI Parking Simulation (slot1) ---\n")
+
+    edge_tx = trad_tx = 0
+    last_state = None
+    for chunk, pred_score in predict_chunks(feature_chunks()):
+        chunk["occupied_now"] = (chunk["g1_min"] < CHANGE_THRESHOLD_MM).astype(np.int8)
+        chunk["pred_score"] = pred_score
+        chunk["pred_label"] = (pred_score > 0).astype(np.int8)
+
+        chunk_edge_tx, chunk_trad_tx, last_state = run_simulation(chunk, last_state)
+        edge_tx += chunk_edge_tx
+        trad_tx += chunk_trad_tx
 
     reduction = 100 * (1 - edge_tx / trad_tx) if trad_tx > 0 else 0.0
     summary = f"Traditional={trad_tx}, EdgeAI={edge_tx}, Reduction={reduction:.2f}%"
@@ -0,0 +1,25 @@
+# export_onnx.py
+# One-time conversion of the trained stability model to ONNX so that
+# edge_simulator.py can run inference through ONNX Runtime.
+import joblib
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType
+
+MODEL_PATH = "stability_model.pkl"
+ONNX_MODEL_PATH = "stability.onnx"
+N_FEATURES = 11  # len(FEATURE_COLS) in edge_simulator.py
+
+if __name__ == "__main__":
+    print("Loading ML model...")
+    clf = joblib.load(MODEL_PATH)
+
+    # raw_scores: the "probabilities" output carries decision-function
+    # logits (column 1 = change), which is what the simulator thresholds
+    onx = convert_sklearn(
+        clf,
+        initial_types=[("X", FloatTensorType([None, N_FEATURES]))],
+        options={id(clf): {"zipmap": False, "raw_scores": True}},
+    )
+    with open(ONNX_MODEL_PATH, "wb") as f:
+        f.write(onx.SerializeToString())
+    print(f"Wrote {ONNX_MODEL_PATH}")
@@ -1,5 +1,26 @@
 # mqtt_shared.py
+import functools
 import queue
+import re
+import socket
 
 # One global queue, imported by both app and MQTT thread code
 msg_queue = queue.Queue()
+
+_SLOT_RE = re.compile(r"slot(\d+)")
+
+
+# Lives here rather than in the Streamlit script so the cache survives reruns
+@functools.lru_cache(maxsize=128)
+def slot_of(topic: str) -> str:
+    """Slot id for a topic; memoized since only a handful of topics ever appear."""
+    m_slot = _SLOT_RE.search(topic)
+    return f"slot{m_slot.group(1)}" if m_slot else "slot1"  # default fallback
+
+
+def set_tcp_nodelay(client, userdata, sock):
+    """paho on_socket_open callback: disable Nagle on every (re)connected socket."""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError) as e:  # e.g. websocket wrappers
+        print("⚠️ TCP_NODELAY not set:", e)
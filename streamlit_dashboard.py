@@ -2,20 +2,23 @@
 import streamlit as st
 from streamlit_autorefresh import st_autorefresh
 import threading
-import re
+import json
+import numpy as np
 import pandas as pd
+import altair as alt
 from collections import deque
-import plotly.express as px
 import paho.mqtt.client as mqtt
 
-from mqtt_shared import msg_queue  # shared queue (persisted outside Streamlit)
+from mqtt_shared import msg_queue, set_tcp_nodelay, slot_of  # persisted outside Streamlit reruns
 
 
 # -------------------------
 # basic UI refresh
 # -------------------------
 st.set_page_config(layout="wide", page_title="EdgeAI Smart Parking Dashboard")
-st_autorefresh(interval=700, key="refresh")
+REFRESH_ACTIVE_MS = 500   # rerun interval while messages are arriving
+REFRESH_IDLE_MS = 2500    # rerun interval once the stream goes quiet
+IDLE_AFTER_S = 5
 
 
 # -------------------------
@@ -26,25 +29,72 @@ def init(key, default):
         st.session_state[key] = default
 
 
-# containers are dicts: slot_id -> deque
+class RingBuf:
+    """Fixed-capacity (ts, value) log stored as two numpy columns."""
+
+    def __init__(self, capacity=2000):
+        self.ts = np.empty(capacity, dtype="datetime64[ns]")
+        self.val = np.empty(capacity, dtype="f4")
+        self.head = 0  # next write position
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def append(self, ts, val):
+        try:
+            val = float(val)
+        except (TypeError, ValueError):
+            val = np.nan  # missing / non-numeric payloads
+        self.ts[self.head] = pd.Timestamp(ts).to_datetime64()
+        self.val[self.head] = val
+        self.head = (self.head + 1) % len(self.ts)
+        self.n = min(self.n + 1, len(self.ts))
+
+    def latest(self):
+        """Most recent (ts, value), or (None, None) when empty."""
+        if not self.n:
+            return None, None
+        i = self.head - 1
+        return pd.Timestamp(self.ts[i]), self.val[i]
+
+    def to_arrays(self):
+        """(ts, val) in chronological order; views until the buffer wraps."""
+        if self.n < len(self.ts):
+            return self.ts[:self.n], self.val[:self.n]
+        return np.roll(self.ts, -self.head), np.roll(self.val, -self.head)
+
+
+# containers are dicts: slot_id -> log
 init("events", {})        # events[slot] = deque((ts,type,info), maxlen=2000)
-init("pred_probs", {})    # pred_probs[slot] = deque((ts,prob), maxlen=2000)
-init("occupancy", {})     # occupancy[slot] = deque((ts,state), maxlen=2000)
+init("pred_probs", {})    # pred_probs[slot] = RingBuf of (ts, prob)
+init("occupancy", {})     # occupancy[slot] = RingBuf of (ts, state)
 init("raw_log", deque(maxlen=2000))  # global raw messages
 init("metrics", {"Traditional": None, "EdgeAI": None, "Reduction": None})
 init("mqtt_started", False)
+init("last_msg_ts", None)
 
 
 # -------------------------
 # payload parsing (multi-slot aware)
 # -------------------------
+def parse_fields(body: str) -> dict:
+    """Split 'k1=v1, k2=v2' into {k1: v1, k2: v2} (keys/values stripped)."""
+    fields = {}
+    for kv in body.split(","):
+        k, sep, v = kv.partition("=")
+        if sep:
+            fields[k.strip()] = v.strip()
+    return fields
+
+
 def ensure_slot_structs(slot_id: str):
     if slot_id not in st.session_state.events:
         st.session_state.events[slot_id] = deque(maxlen=2000)
     if slot_id not in st.session_state.pred_probs:
-        st.session_state.pred_probs[slot_id] = deque(maxlen=2000)
+        st.session_state.pred_probs[slot_id] = RingBuf(2000)
     if slot_id not in st.session_state.occupancy:
-        st.session_state.occupancy[slot_id] = deque(maxlen=2000)
+        st.session_state.occupancy[slot_id] = RingBuf(2000)
 
 
 def parse_payload(topic: str, payload: str):
@@ -53,20 +103,20 @@ def parse_payload(topic: str, payload: str):
       - smartparking/slot{n}/event : "PRED_CHANGE: prob=0.998, ts=..."
       - smartparking/slot{n}/event : "CHANGE: state=0, ts=..."
       - smartparking/slot{n}/state : "0" or "1"
+      - smartparking/slot{n}/batch : '{"state": 0, "event": "CHANGE", "ts": "..."}' (or a JSON array of these)
       - smartparking/metrics/transmissions: "Traditional=1000, EdgeAI=483, Reduction=51.70%"
     """
     now = pd.Timestamp.now()
     text = payload.strip()
 
     # detect slot id if present
-    m_slot = re.search(r"slot(\d+)", topic)
-    slot_id = f"slot{m_slot.group(1)}" if m_slot else "slot1"  # default fallback
+    slot_id = slot_of(topic)
     ensure_slot_structs(slot_id)
 
     # metrics (global)
     if topic.endswith("metrics/transmissions"):
-        m = re.findall(r"(\w+)=([\d\.]+)", text)
-        for k, v in m:
+        for k, v in parse_fields(text).items():
+            v = v.rstrip("%")
             if k in ("Traditional", "EdgeAI"):
                 try:
                     st.session_state.metrics[k] = int(float(v))
@@ -81,23 +131,44 @@ def parse_payload(topic: str, payload: str):
         st.session_state.events[slot_id].appendleft((now, "METRICS", text))
         return
 
+    # batched events (JSON object or array of objects)
+    if topic.endswith("/batch"):
+        batch = json.loads(text)
+        if isinstance(batch, dict):
+            batch = [batch]
+        for ev in batch:
+            kind = ev.get("event", "MSG")
+            if kind == "CHANGE":
+                state = ev.get("state")
+                st.session_state.occupancy[slot_id].append(now, state)
+                st.session_state.events[slot_id].appendleft((now, "CHANGE", f"state={state}"))
+            elif kind == "PRED_CHANGE":
+                prob = ev.get("prob")
+                st.session_state.pred_probs[slot_id].append(now, prob)
+                st.session_state.events[slot_id].appendleft((now, "PRED_CHANGE", f"prob={prob}"))
+            else:
+                st.session_state.events[slot_id].appendleft((now, kind, json.dumps(ev)))
+        st.session_state.raw_log.appendleft((now, topic, text))
+        return
+
     # PRED_CHANGE events
-    if "PRED_CHANGE" in text:
-        prob_match = re.search(r"prob=([\d\.]+)", text)
-        prob = float(prob_match.group(1)) if prob_match else None
-        st.session_state.pred_probs[slot_id].appendleft((now, prob))
+    if text.startswith("PRED_CHANGE"):
+        try:
+            prob = float(parse_fields(text.split(":", 1)[-1])["prob"])
+        except (KeyError, ValueError):
+            prob = None
+        st.session_state.pred_probs[slot_id].append(now, prob)
         st.session_state.events[slot_id].appendleft((now, "PRED_CHANGE", f"prob={prob}"))
         st.session_state.raw_log.appendleft((now, topic, text))
         return
 
     # CHANGE event (explicit state change)
     if text.startswith("CHANGE"):
-        st_match = re.search(r"state\s*=\s*(\d+)", text)
         try:
-            state = int(st_match.group(1)) if st_match else None
-        except Exception:
+            state = int(parse_fields(text.split(":", 1)[-1])["state"])
+        except (KeyError, ValueError):
             state = None
-        st.session_state.occupancy[slot_id].appendleft((now, state))
+        st.session_state.occupancy[slot_id].append(now, state)
         st.session_state.events[slot_id].appendleft((now, "CHANGE", f"state={state}"))
         st.session_state.raw_log.appendleft((now, topic, text))
         return
@@ -108,7 +179,7 @@ def parse_payload(topic: str, payload: str):
             s = int(text)
         except Exception:
             s = text
-        st.session_state.occupancy[slot_id].appendleft((now, s))
+        st.session_state.occupancy[slot_id].append(now, s)
         st.session_state.events[slot_id].appendleft((now, "STATE", str(s)))
         st.session_state.raw_log.appendleft((now, topic, text))
         return
@@ -121,9 +192,13 @@ def parse_payload(topic: str, payload: str):
 # -------------------------
 # drain shared queue on each rerun
 # -------------------------
+# snapshot + clear under a single lock acquire instead of one get_nowait() per message
+with msg_queue.mutex:
+    batch = list(msg_queue.queue)
+    msg_queue.queue.clear()
+
 processed = 0
-while not msg_queue.empty():
-    topic, payload = msg_queue.get_nowait()
+for topic, payload in batch:
     print("📥 Processing:", topic, payload)
     try:
         parse_payload(topic, payload)
@@ -136,6 +211,14 @@ while not msg_queue.empty():
 
 if processed:
     print(f"UI updated with {processed} messages")
+    st.session_state.last_msg_ts = pd.Timestamp.now()
+
+# back off reruns while nothing is arriving
+last_msg_ts = st.session_state.last_msg_ts
+idle = processed == 0 and (
+    last_msg_ts is None or (pd.Timestamp.now() - last_msg_ts).total_seconds() > IDLE_AFTER_S
+)
+st_autorefresh(interval=REFRESH_IDLE_MS if idle else REFRESH_ACTIVE_MS, key="refresh")
 
 # quick sidebar diagnostics
 st.sidebar.write("Processed this run:", processed)
@@ -164,6 +247,8 @@ def mqtt_thread():
     client = mqtt.Client()
     client.on_connect = on_connect
     client.on_message = on_message
+    # disable Nagle so small MQTT packets aren't held back (also after reconnects)
+    client.on_socket_open = set_tcp_nodelay
     try:
         client.connect("localhost", 1883, 60)
         print("📡 MQTT connected.")
@@ -178,6 +263,37 @@ if not st.session_state.mqtt_started:
     st.session_state.mqtt_started = True
 
 
+# -------------------------
+# cached table data (unchanged data -> no rebuild)
+# -------------------------
+def log_signature(q):
+    """Cheap (size, newest ts) fingerprint of a newest-first (ts, ...) deque."""
+    return (len(q), q[0][0].value if q else 0)
+
+
+# `_events` / `_raw_log` are not hashed by st.cache_data; `sig` stands in for them,
+# so entries never go stale and need no ttl -- max_entries bounds memory
+@st.cache_data(max_entries=4)
+def build_events_table(sig, _events):
+    rows = []
+    for slot, evq in _events.items():
+        for it in list(evq)[:6]:  # top few per slot (most recent first)
+            rows.append((slot, it[0], it[1], it[2]))
+    if not rows:
+        return None
+    df_rows = pd.DataFrame(rows, columns=["slot", "ts", "type", "info"])
+    df_rows["ts_str"] = df_rows["ts"].dt.strftime("%H:%M:%S")
+    df_rows = df_rows.sort_values("ts", ascending=False)
+    return df_rows.head(12)
+
+
+@st.cache_data(max_entries=4)
+def build_raw_log_table(sig, _raw_log):
+    df_log = pd.DataFrame(list(_raw_log)[:50], columns=["ts", "topic", "payload"])
+    df_log["ts_str"] = df_log["ts"].dt.strftime("%H:%M:%S")
+    return df_log.sort_values("ts", ascending=False)
+
+
 # -------------------------
 # UI layout
 # -------------------------
@@ -194,11 +310,10 @@ if slot_ids:
     for i, slot in enumerate(slot_ids):
         col = cols[i % 4]
         with col:
-            latest = st.session_state.occupancy[slot][0] if st.session_state.occupancy[slot] else (None, None)
-            ts, state = latest
+            ts, state = st.session_state.occupancy[slot].latest()
 
             status = "No data"
-            if state is None:
+            if state is None or np.isnan(state):
                 status = "No data"
             elif state == 0:
                 status = "🟩 EMPTY"
@@ -222,15 +337,11 @@ with col1:
 
     st.markdown("---")
     st.subheader("Recent Events")
-    rows = []
-    for slot, evq in st.session_state.events.items():
-        for it in list(evq)[:6]:  # top few per slot (most recent first)
-            rows.append((slot, it[0], it[1], it[2]))
-    if rows:
-        df_rows = pd.DataFrame(rows, columns=["slot", "ts", "type", "info"])
-        df_rows["ts_str"] = df_rows["ts"].dt.strftime("%H:%M:%S")
-        df_rows = df_rows.sort_values("ts", ascending=False)
-        st.table(df_rows.head(12))
+    events = st.session_state.events
+    sig = tuple((slot, *log_signature(evq)) for slot, evq in events.items())
+    df_rows = build_events_table(sig, events)
+    if df_rows is not None:
+        st.table(df_rows)
     else:
         st.write("No events yet.")
 
@@ -238,52 +349,47 @@ with col2:
     st.subheader("Prediction Probabilities")
     for slot in slot_ids:
         st.markdown(f"#### {slot.upper()}")
-        preds = list(st.session_state.pred_probs.get(slot, []))
-        if not preds:
+        rb = st.session_state.pred_probs.get(slot)
+        if not rb:
             st.write("No prediction events.")
             continue
-        dfp = pd.DataFrame(preds, columns=["ts", "prob"])
-        dfp["time"] = dfp["ts"].dt.strftime("%H:%M:%S")
-        fig = px.line(
-            dfp.tail(200),
-            x="time",
-            y="prob",
-            range_y=[0, 1],
-            title=f"{slot} predicted change prob",
+        ts, prob = rb.to_arrays()
+        st.caption(f"{slot} predicted change prob")
+        dfp = pd.DataFrame({"time": ts[-200:], "prob": prob[-200:]})
+        chart = alt.Chart(dfp).mark_line().encode(
+            x="time:T",
+            y=alt.Y("prob:Q", scale=alt.Scale(domain=[0, 1])),
         )
-        st.plotly_chart(fig, width="stretch")
+        st.altair_chart(chart, width="stretch")
 
 st.markdown("---")
 st.subheader("Occupancy Timelines")
 for slot in slot_ids:
     st.markdown(f"##### {slot.upper()}")
-    occ = list(st.session_state.occupancy.get(slot, []))
-    if not occ:
+    rb = st.session_state.occupancy.get(slot)
+    if not rb:
         st.write("No occupancy updates.")
         continue
-    df_occ = pd.DataFrame(occ, columns=["ts", "state"])
-    df_occ["time"] = df_occ["ts"].dt.strftime("%H:%M:%S")
-    fig_occ = px.line(
-        df_occ.tail(200),
-        x="time",
-        y="state",
-        line_shape="hv",  # step-like
-        title=f"{slot} occupancy",
+    ts, state = rb.to_arrays()
+    st.caption(f"{slot} occupancy")
+    df_occ = pd.DataFrame({"time": ts[-200:], "state": state[-200:]})
+    # occupancy is binary: hold each value until the next update
+    chart = alt.Chart(df_occ).mark_line(interpolate="step-after").encode(
+        x="time:T",
+        y=alt.Y("state:Q", scale=alt.Scale(domain=[0, 1]), axis=alt.Axis(values=[0, 1])),
     )
-    fig_occ.update_yaxes(tickvals=[0, 1])
-    st.plotly_chart(fig_occ, width="stretch")
+    st.altair_chart(chart, width="stretch")
 
 st.markdown("---")
 st.subheader("Raw MQTT Log (most recent)")
 if st.session_state.raw_log:
-    df_log = pd.DataFrame(list(st.session_state.raw_log), columns=["ts", "topic", "payload"])
-    df_log["ts_str"] = df_log["ts"].dt.strftime("%H:%M:%S")
-    df_log = df_log.sort_values("ts", ascending=False)
-    st.dataframe(df_log.head(50))
+    raw_log = st.session_state.raw_log
+    st.dataframe(build_raw_log_table(log_signature(raw_log), raw_log))
 else:
     st.write("No raw messages yet.")
 
 st.caption(
     "Tip: run mosquitto + edge_simulator.py (multi-slot) to populate this dashboard. "
-    "Topics: smartparking/slot{n}/event, smartparking/slot{n}/state, smartparking/metrics/transmissions"
+    "Topics: smartparking/slot{n}/event, smartparking/slot{n}/state, smartparking/slot{n}/batch, "
+    "smartparking/metrics/transmissions"
 )